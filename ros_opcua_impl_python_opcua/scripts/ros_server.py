@@ -1,41 +1,227 @@
 #!/usr/bin/python
+import os
 import sys
+import json
 import time
+import random
 import logging
+import threading
+import xmlrpclib
+from multiprocessing.pool import ThreadPool
 
 import rospy
 import rosgraph
 import rosnode
+import rosservice
 import std_srvs.srv
 
 import opcua
-from opcua import ua
+from opcua import ua, uamethod
 
 import ros_services
 import ros_topics
+import ros_types
 import ros_actions
 import ros_utils
 
 
-# Returns the hierachy as one string from the first remaining part on.
-def nextname(hierachy, index_of_last_processed):
-    try:
-        output = ""
-        counter = index_of_last_processed + 1
-        while counter < len(hierachy):
-            output += hierachy[counter]
-            counter += 1
-        return output
-    except Exception as ex:
-        rospy.logerr("Error encountered ", ex)
+class TimeoutTransport(xmlrpclib.Transport):
+
+    def __init__(self, timeout):
+        xmlrpclib.Transport.__init__(self)
+        self.timeout = timeout
+
+
+    def make_connection(self, host):
+        connection = xmlrpclib.Transport.make_connection(self, host)
+        connection.timeout = self.timeout
+        return connection
+
+
+class NodeCleanup:
+    """
+    Removes nodes that don't answer a ping from the master,
+    at most once every interval seconds in a background thread
+    """
+
+    # same ping timeout as rosnode, a missed ping drops all registrations of the node
+    def __init__(self, interval=10.0, timeout=3.0, num_threads=8):
+        self.interval = interval
+        self.timeout = timeout
+        self.num_threads = num_threads
+
+        # node name -> XML-RPC uri, saves a master lookup per ping
+        self.uris = {}
+        self.lock = threading.Lock()
+        self.pending = False
+        self.last_run = 0.0
+        self.thread = None
+
+
+    # called when ROS entities disappeared, the cleanup itself runs on the next run_pending()
+    def schedule(self):
+        self.pending = True
+
+
+    def run_pending(self):
+        with self.lock:
+            if not self.pending or time.time() - self.last_run < self.interval:
+                return
+            if self.thread is not None and self.thread.is_alive():
+                return
+            self.pending = False
+            self.last_run = time.time()
+            self.thread = threading.Thread(target=self.run, name="opcua_node_cleanup")
+            self.thread.daemon = True
+            self.thread.start()
+
+
+    def run(self):
+        try:
+            master = rosgraph.Master(rosnode.ID)
+            node_names = rosnode.get_node_names()
+            if not node_names:
+                return
+
+            pool = ThreadPool(min(self.num_threads, len(node_names)))
+            try:
+                alive = pool.map(lambda node_name: self.ping(master, node_name), node_names)
+            finally:
+                pool.close()
+                pool.join()
+
+            unpinged = [node_name for node_name, node_alive in zip(node_names, alive) if not node_alive]
+            if unpinged:
+                rospy.loginfo("Cleaning up unreachable nodes: %s", ", ".join(unpinged))
+                # noinspection PyTypeChecker
+                rosnode.cleanup_master_blacklist(master, unpinged)
+        except Exception as ex:
+            rospy.logerr("Error while cleaning up ROS nodes: %s", ex)
+
+
+    def ping(self, master, node_name):
+        try:
+            uri = self.uris.get(node_name)
+            if uri is None:
+                uri = master.lookupNode(node_name)
+                self.uris[node_name] = uri
+            xmlrpclib.ServerProxy(uri, transport=TimeoutTransport(self.timeout)).getPid(rosnode.ID)
+            return True
+        except Exception:
+            self.uris.pop(node_name, None)
+            return False
+
+
+class RefreshScheduler:
+
+    def __init__(self, ros_server, period, jitter=0.1, max_backoff=10.0):
+        self.ros_server = ros_server
+        self.period = period
+        self.jitter = jitter
+        self.max_backoff = max_backoff
+
+        self.backoff = 0.0
+        self.running = False
+        self.event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="opcua_refresh")
+        self.thread.daemon = True
 
 
-def own_rosnode_cleanup():
-    pinged, unpinged = rosnode.rosnode_ping_all()
-    if unpinged:
-        master = rosgraph.Master(rosnode.ID)
-        # noinspection PyTypeChecker
-        rosnode.cleanup_master_blacklist(master, unpinged)
+    def start(self):
+        self.running = True
+        self.thread.start()
+
+
+    def stop(self):
+        self.running = False
+        self.event.set()
+        self.thread.join()
+
+
+    # refresh as soon as possible, called from OPC-UA and ROS request handlers
+    def trigger(self):
+        self.event.set()
+
+
+    def next_delay(self):
+        if self.period <= 0.0:
+            # on demand only
+            return None
+        return self.period * (1.0 + self.backoff) + random.uniform(0.0, self.jitter * self.period)
+
+
+    def run(self):
+        while self.running and not rospy.is_shutdown():
+            self.event.wait(self.next_delay())
+            self.event.clear()
+            if not self.running:
+                return
+
+            start = time.time()
+            try:
+                self.ros_server.refresh()
+            except Exception as ex:
+                rospy.logerr("Error while refreshing OPC-UA Server: %s", ex)
+                self.slow_down()
+                continue
+
+            # the master is slow, refresh less often, on demand refreshes have no period to stretch
+            if self.period > 0.0 and time.time() - start > self.period / 2.0:
+                self.slow_down()
+            else:
+                self.backoff = 0.0
+
+
+    def slow_down(self):
+        if self.period <= 0.0:
+            return
+        self.backoff = min(max(2.0 * self.backoff, 1.0), self.max_backoff)
+        rospy.logwarn("Slowing down OPC-UA Server refresh to every %.1f s", self.period * (1.0 + self.backoff))
+
+
+class AddressSpaceCache:
+    """
+    Generated namespace saved on disk, the message type layouts
+    keyed by their MD5 sum and the topics, services and actions
+    with their types, restored on startup before the first refresh
+    """
+
+    version = 1
+
+    def __init__(self, path):
+        self.path = os.path.expanduser(path)
+
+
+    def load(self):
+        try:
+            with open(self.path) as cache_file:
+                data = json.load(cache_file)
+        except IOError:
+            return None
+        except ValueError as ex:
+            rospy.logwarn("Ignoring invalid address space cache '%s': %s", self.path, ex)
+            return None
+
+        if data.get('version') != self.version:
+            return None
+        return data
+
+
+    def save(self, types, topics, services, actions):
+        data = {
+            'version': self.version,
+            'types': types,
+            'topics': topics,
+            'services': services,
+            'actions': actions,
+        }
+        # written aside and renamed, a crash never leaves a truncated cache
+        try:
+            with open(self.path + '.tmp', 'w') as cache_file:
+                json.dump(data, cache_file)
+            os.rename(self.path + '.tmp', self.path)
+        except (IOError, OSError) as ex:
+            rospy.logwarn("Error saving address space cache '%s': %s", self.path, ex)
 
 
 class ROSServer:
@@ -49,15 +235,63 @@ class ROSServer:
         self.services_dict = {}
         self.topics_dict = {}
         self.actions_dict = {}
-
-        # whitelist
-        self.services_whitelist = rospy.get_param("~services/whitelist")
-        self.topics_whitelist = rospy.get_param("~topics/whitelist")
+        # (root node id, namespace path) -> folder node
+        self.folders = {}
+
+        self.node_cleanup = NodeCleanup(rospy.get_param("~refresh_time", 10.0), rospy.get_param("~node_cleanup/timeout", 3.0))
+
+        # whitelist and blacklist, names or patterns
+        self.services_whitelist = ros_utils.NameFilter(rospy.get_param("~services/whitelist"), rospy.get_param("~services/blacklist", []))
+        self.topics_whitelist = ros_utils.NameFilter(rospy.get_param("~topics/whitelist"), rospy.get_param("~topics/blacklist", []))
+        self.actions_whitelist = ros_utils.NameFilter(rospy.get_param("~actions/whitelist", []), rospy.get_param("~actions/blacklist", []))
+
+        # per topic rate limit and deadband
+        self.topics_filters = {}
+        for settings in rospy.get_param("~topics/filters", []):
+            self.topics_filters[settings['topic']] = settings
+
+        # decouple subscriber callbacks from OPC-UA writes, 0 writes in the subscriber thread
+        writer_threads = rospy.get_param("~topics/writer_threads", 0)
+        if writer_threads > 0:
+            self.topics_writer = ros_topics.TopicWriter(writer_threads, rospy.get_param("~topics/writer_queue_size", 100))
+        else:
+            self.topics_writer = None
+
+        # ROS service calls run in a thread pool with per service timeout and concurrency limit
+        services_threads = rospy.get_param("~services/threads", 4)
+        self.services_pool = ros_services.ServiceCallPool(services_threads)
+        self.services_timeout = rospy.get_param("~services/timeout", 10.0)
+        # by default as many calls of one service as the pool runs at once
+        self.services_max_concurrent_calls = rospy.get_param("~services/max_concurrent_calls", services_threads)
+        self.services_limits = {}
+        for limits in rospy.get_param("~services/limits", []):
+            self.services_limits[limits['service']] = limits
+
+        # finished goals of each action kept in the address space
+        self.actions_history = rospy.get_param("~actions/history", 10)
+
+        # namespace of the previous run, empty path disables the cache
+        cache_file = rospy.get_param("~cache_file", "")
+        self.cache = AddressSpaceCache(cache_file) if cache_file else None
+
+        # serializes address space changes of concurrent refreshes
+        self.refresh_lock = threading.Lock()
+        self.refresh_scheduler = None
 
         self.server = opcua.Server()
         self.server.set_endpoint(endpoint)
         self.server.set_server_name(server_name)
 
+        # lazy topics are created as a bare object, their fields and ROS subscription
+        # when a client browses or monitors them, released after an idle time,
+        # on demand topics are only subscribed while clients monitor their values
+        self.topics_lazy = rospy.get_param("~topics/lazy", False)
+        self.topics_on_demand = rospy.get_param("~topics/on_demand", False)
+        if self.topics_lazy or self.topics_on_demand:
+            self.topics_demand = ros_topics.TopicDemand(self.server, rospy.get_param("~topics/idle_time", 60.0))
+        else:
+            self.topics_demand = None
+
 
     def server_config(self, server):
         """
@@ -124,6 +358,10 @@ class ROSServer:
 
         self.server_config(self.server)
 
+        if self.topics_writer is not None:
+            self.topics_writer.start()
+        self.services_pool.start()
+
         uri_topics = "http://ros.org/topics"
         uri_services = "http://ros.org/services"
         uri_actions = "http://ros.org/actions"
@@ -131,13 +369,38 @@ class ROSServer:
         self.idx_services = self.server.register_namespace(uri_services)
         self.idx_actions = self.server.register_namespace(uri_actions)
 
+        # object types of the ROS message types, generated on first use
+        self.message_types = ros_types.MessageTypes(self.server, self.idx_topics)
+
         objects = self.server.get_objects_node()
+
+        # incremented on every refresh changing the address space
+        self.generation = 0
+        self.generation_node = objects.add_variable(self.idx_topics, "Generation", ua.Variant(self.generation, ua.VariantType.UInt32))
+        objects.add_method(self.idx_topics, "Refresh", self.opcua_refresh_callback, [], [])
+
         self.topics_object = objects.add_folder(self.idx_topics, "ROS-Topics")
         self.services_object = objects.add_folder(self.idx_services, "ROS-Services")
         self.actions_object = objects.add_folder(self.idx_actions, "ROS-Actions")
 
+        # event type of the goal status transitions, fired by the action objects
+        self.action_status_event_type = ros_actions.create_status_event_type(self.server, self.idx_actions)
+
+
+    def start_refresh(self, period):
+        self.refresh_scheduler = RefreshScheduler(self, period)
+        self.refresh_scheduler.start()
+        self.refresh_service = rospy.Service("~refresh", std_srvs.srv.Trigger, self.ros_refresh_callback)
+
 
     def stop(self):
+        if self.refresh_scheduler is not None:
+            self.refresh_service.shutdown()
+            self.refresh_scheduler.stop()
+        if self.topics_writer is not None:
+            self.topics_writer.stop()
+            self.log_writer_counters()
+        self.services_pool.stop()
         self.server.stop()
         rospy.loginfo("Stopped OPC-UA Server %s/%s", self.endpoint, self.server_name)
 
@@ -145,44 +408,110 @@ class ROSServer:
     def refresh(self, clean_all=False):
         rospy.loginfo("Refreshing OPC-UA Server %s/%s ...", self.endpoint, self.server_name)
 
-        #ros_services.clean_dict(self.ros_namespace, self, self.services_dict, self.idx_services, clean_all)
-        ros_topics.clean_dict(self.ros_namespace, self, self.topics_dict, self.idx_topics, clean_all)
+        # one master snapshot per refresh, only the difference is applied
+        ros_topics_list = rospy.get_published_topics(namespace=self.ros_namespace)
+        ros_services_list = rosservice.get_service_list(namespace=self.ros_namespace)
+
+        changed = self.apply(ros_topics_list, ros_services_list, clean_all)
+        if changed and self.cache is not None:
+            self.save_cache()
 
-        #ros_services.refresh_services(self.ros_namespace, self, self.services_dict, self.idx_services, self.services_object)
-        ros_topics.refresh_topics(self.ros_namespace, self, self.topics_dict, self.idx_topics, self.topics_object)
-        # ros_actions.refresh_actions(ros_server.ros_namespace, ros_server, ros_server.actions_dict, ros_server.idx_actions, ros_server.actions_object)
+        self.node_cleanup.run_pending()
+
+        if self.topics_writer is not None:
+            self.log_writer_counters()
 
         return True
 
 
-    def find_service_node_with_same_name(self, name, idx):
-        rospy.logdebug("Reached ServiceCheck for name " + name)
-        for service in self.services_dict:
-            rospy.logdebug("Found name: " + str(self.services_dict[service].parent.nodeid.Identifier))
-            if self.services_dict[service].parent.nodeid.Identifier == name:
-                rospy.logdebug("Found match for name: " + name)
-                return self.services_dict[service].parent
-        return None
+    def apply(self, ros_topics_list, ros_services_list, clean_all=False, service_types=None, action_types=None):
+        # address space changes are applied node by node, clients browsing
+        # in the meantime only wait for single node operations
+        with self.refresh_lock:
+            changed = ros_services.refresh_services(self, self.services_dict, self.idx_services, self.services_object, ros_services_list, clean_all, service_types)
+            changed = ros_topics.refresh_topics(self, self.topics_dict, self.idx_topics, self.topics_object, ros_topics_list, clean_all) or changed
+            # actions are found in the same topic snapshot, without further master calls
+            changed = ros_actions.refresh_actions(self, self.actions_dict, self.idx_actions, self.actions_object, ros_topics_list, clean_all, action_types) or changed
+
+            if changed:
+                self.generation += 1
+                self.generation_node.set_value(ua.Variant(self.generation, ua.VariantType.UInt32))
+                rospy.loginfo("OPC-UA address space generation %d", self.generation)
 
+        return changed
 
-    def find_topics_node_with_same_name(self, name, idx):
-        rospy.logdebug("Reached TopicCheck for name " + name)
-        for topic in self.topics_dict:
-            rospy.logdebug("Found name: " + str(self.topics_dict[topic].parent.nodeid.Identifier))
-            if self.topics_dict[topic].parent.nodeid.Identifier == name:
-                rospy.logdebug("Found match for name: " + name)
-                return self.topics_dict[topic].parent
-        return None
 
+    # build the namespace of the previous run without asking the master,
+    # the first refresh then only applies what changed in the meantime
+    def restore(self):
+        if self.cache is None:
+            return
+        data = self.cache.load()
+        if data is None:
+            return
 
-    def find_action_node_with_same_name(self, name, idx):
-        rospy.logdebug("Reached ActionCheck for name " + name)
-        for topic in self.actions_dict:
-            rospy.logdebug("Found name: " + str(self.actions_dict[topic].parent.nodeid.Identifier))
-            if self.actions_dict[topic].parent.nodeid.Identifier == name:
-                rospy.logdebug("Found match for name: " + name)
-                return self.actions_dict[topic].parent
-        return None
+        self.message_types.load(data['types'])
+        ros_topics_list = [(str(name), str(type_name)) for name, type_name in data['topics']]
+        service_types = dict((str(name), str(type_name)) for name, type_name in data['services'])
+        # caches written before actions were mapped have none
+        action_types = dict((str(name), str(type_name)) for name, type_name in data.get('actions', []))
+        self.apply(ros_topics_list, service_types.keys(), service_types=service_types, action_types=action_types)
+        rospy.loginfo("Restored %d topics, %d services and %d actions from '%s'",
+                      len(self.topics_dict), len(self.services_dict), len(self.actions_dict), self.cache.path)
+
+
+    def save_cache(self):
+        with self.refresh_lock:
+            topics = [[name, topic.topic_type] for name, topic in self.topics_dict.items()]
+            services = [[name, service.service_type] for name, service in self.services_dict.items()]
+            actions = [[name, action.type] for name, action in self.actions_dict.items()]
+        self.cache.save(self.message_types.dump(), topics, services, actions)
+
+
+    # trigger an asynchronous refresh, the OPC-UA request is not blocked by the discovery
+    @uamethod
+    def opcua_refresh_callback(self, parent):
+        if self.refresh_scheduler is not None:
+            self.refresh_scheduler.trigger()
+
+
+    def ros_refresh_callback(self, req):
+        self.refresh_scheduler.trigger()
+        return std_srvs.srv.TriggerResponse(True, "Refresh scheduled")
+
+
+    def log_writer_counters(self):
+        rospy.loginfo("OPC-UA topic writer: %d written, %d coalesced, %d dropped messages",
+                      self.topics_writer.written, self.topics_writer.coalesced, self.topics_writer.dropped)
+
+
+    def get_folder(self, root, name):
+        """
+        Return the folder node of the namespace of name below root,
+        missing folders are created and indexed by their namespace path
+        """
+        folder = root
+        path = ''
+        for segment in name.split('/')[:-1]:
+            if segment == '':
+                continue
+            path += '/' + segment
+            child = self.folders.get((root.nodeid, path))
+            if child is None:
+                # trailing '/' keeps folder ids apart from topic and service ids
+                child = folder.add_folder(ua.NodeId(path + '/', root.nodeid.NamespaceIndex, ua.NodeIdType.String),
+                                          ua.QualifiedName(segment, root.nodeid.NamespaceIndex))
+                self.folders[(root.nodeid, path)] = child
+            folder = child
+        return folder
+
+
+    def delete_empty_folders(self, root, folder):
+        while folder != root and len(folder.get_children()) == 0:
+            parent = folder.get_parent()
+            self.server.delete_nodes([folder])
+            self.folders.pop((root.nodeid, folder.nodeid.Identifier[:-1]), None)
+            folder = parent
 
 
 if __name__ == '__main__':
@@ -197,14 +526,15 @@ if __name__ == '__main__':
     startup_time = rospy.get_param("~startup_time", 0.0)
     refresh_time = rospy.get_param("~refresh_time", 10.0)
 
-    rospy.sleep(startup_time)
-
     # ROS OPC-UA Server
     ros_server = ROSServer(server_endpoint, server_name)
     ros_server.start()
+    ros_server.restore()
+
+    rospy.sleep(startup_time)
 
-    ros_services.refresh_services(ros_server.ros_namespace, ros_server, ros_server.services_dict, ros_server.idx_services, ros_server.services_object)
-    ros_topics.refresh_topics(ros_server.ros_namespace, ros_server, ros_server.topics_dict, ros_server.idx_topics, ros_server.topics_object)
+    ros_server.refresh()
+    ros_server.start_refresh(refresh_time)
 
     rospy.spin()
 
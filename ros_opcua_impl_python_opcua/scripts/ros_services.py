@@ -1,8 +1,9 @@
 # Thanks to:
 # https://github.com/ros-visualization/rqt_common_plugins/blob/groovy-devel/rqt_service_caller/src/rqt_service_caller/service_caller_widget.py
 import math
-import random
+import threading
 import time
+import Queue
 
 import rospy
 import rospy.service
@@ -10,74 +11,205 @@ import rospy.exceptions
 import genpy
 import roslib
 import rosservice
-from opcua import ua, uamethod, common
+from opcua import ua, uamethod
 
 import ros_server
 import ros_utils
 
 
-def clean_dict(ros_namespace, ros_server, services_dict, idx, clean_all=False):
-    ros_services = rosservice.get_service_list()
+def refresh_services(ros_server, services_dict, idx, services_object, ros_services, clean_all=False, service_types=None):
+    """
+    Given the service names of one master snapshot
+    apply only the added and removed services to the address space,
+    service_types holds the already known types,
+    return True if anything changed
+    """
+    service_names = set(ros_services)
+
+    if clean_all:
+        removed = set(services_dict)
+        added = set()
+    else:
+        removed = set(services_dict) - service_names
+        added = set(name for name in service_names if name in ros_server.services_whitelist) - set(services_dict)
+
+    for service_name in removed:
+        opcua_service = services_dict.pop(service_name)
+        opcua_service.delete_nodes()
+        ros_server.delete_empty_folders(services_object, opcua_service.parent)
+
+    for service_name in sorted(added):
+        try:
+            if service_types is not None and service_name in service_types:
+                service_type = service_types[service_name]
+            else:
+                service_type = rosservice.get_service_type(service_name)
+            services_dict[service_name] = OpcUaROSService(ros_server, services_object, idx, service_name, service_type)
+        except (rosservice.ROSServiceException, rosservice.ROSServiceIOException) as ex:
+            rospy.logerr("Error when trying to refresh service '%s': %s", service_name, ex)
+        except ua.UaStatusCodeError as ex:
+            rospy.logerr("Error creating OPC-UA Service '%s': %s", service_name, ex)
+
+    return bool(removed or added)
+
+
+class ServiceCall:
+
+    def __init__(self, function, args):
+        self.function = function
+        self.args = args
+        self.result = None
+        self.done = threading.Event()
+
+
+    def wait(self, timeout=None):
+        return self.done.wait(timeout)
+
+
+class ServiceCallPool:
+
+    def __init__(self, num_threads=4):
+        self.calls = Queue.Queue()
+
+        self.threads = []
+        for index in range(num_threads):
+            thread = threading.Thread(target=self.run, name="opcua_service_call_%d" % index)
+            thread.daemon = True
+            self.threads.append(thread)
 
-    to_be_deleted = []
-    for node_name in services_dict:
 
-        if (node_name not in ros_services) or (clean_all == True):
+    def start(self):
+        for thread in self.threads:
+            thread.start()
 
-            services_dict[node_name].recursive_delete_node(ros_server.server.get_node(ua.NodeId(node_name, idx)))
 
-            if len(services_dict[node_name].parent.get_children()) == 0:
-                ros_server.server.delete_nodes([services_dict[node_name].parent])
+    def stop(self):
+        for thread in self.threads:
+            self.calls.put(None)
+        for thread in self.threads:
+            thread.join()
 
-            to_be_deleted.append(node_name)
 
-    for node_name in to_be_deleted:
-        del services_dict[node_name]
+    def submit(self, function, *args):
+        call = ServiceCall(function, args)
+        self.calls.put(call)
+        return call
 
 
-    # for node_name in services_dict:
-    #     #
-    #     found = False
-    #     for service_name in ros_services:
-    #         if node_name == service_name:
-    #             found = True
-    #     #
-    #     if not found and services_dict[node_name] is not None:
-    #         services_dict[node_name].recursive_delete_nodes(ros_server.server.get_node(ua.NodeId(node_name, idx)))
-    #         to_be_deleted.append(node_name)
-    #     #
-    #     if len(services_dict[node_name].parent.get_children()) == 0:
-    #         ros_server.server.delete_nodes([services_dict[node_name].parent])
-    #
-    # for node_name in to_be_deleted:
-    #     del services_dict[node_name]
+    def run(self):
+        while True:
+            call = self.calls.get()
+            if call is None:
+                return
+            try:
+                call.result = call.function(*call.args)
+            except Exception as ex:
+                rospy.logerr("Error while calling ROS service: %s", ex)
+                call.result = ua.StatusCode(ua.status_codes.StatusCodes.BadUnexpectedError)
+            call.done.set()
 
 
-def refresh_services(ros_namespace, ros_server, services_dict, idx, services_object):
-    ros_services = rosservice.get_service_list(namespace=ros_namespace)
+class ServiceProxyPool:
 
-    for service_name in ros_services:
+    max_backoff = 5.0
+
+    def __init__(self, service_name, service_class, size=1):
+        self.service_name = service_name
+        self.service_class = service_class
+
+        # idle persistent proxies, None stands for a connection not opened yet
+        self.proxies = Queue.Queue()
+        for index in range(size):
+            self.proxies.put(None)
+
+        self.lock = threading.Lock()
+        self.backoff = 0.0
+        self.retry_time = 0.0
+        self.closed = False
 
-        if service_name not in ros_server.services_whitelist:
-            continue
 
+    def call(self, req):
+        proxy = self.acquire()
         try:
-            if service_name not in services_dict or services_dict[service_name] is None:
-                opcua_service = OpcUaROSService(ros_server, services_object, idx, service_name, rosservice.get_service_type(service_name))
-                services_dict[service_name] = opcua_service
-        except (rosservice.ROSServiceException, rosservice.ROSServiceIOException) as ex:
-            rospy.logerr("Error when trying to refresh services", ex)
-        except TypeError as ex:
-            rospy.logerr("Error when logging an Exception, can't convert everything to string")
+            res = proxy.call(req)
+        except rospy.ServiceException:
+            # the service may only have responded with an error, keep the connection if it is still open
+            if not self.is_connected(proxy):
+                proxy.close()
+                proxy = None
+                self.connection_failed()
+            raise
+        finally:
+            self.release(proxy)
+
+        self.connection_succeeded()
+        return res
+
+
+    def acquire(self):
+        proxy = self.proxies.get()
+
+        # health check, connections closed by the service are replaced
+        if proxy is not None and proxy.transport is not None and proxy.transport.done:
+            rospy.logdebug("Reconnecting to ROS service '%s'", self.service_name)
+            proxy.close()
+            proxy = None
+
+        if proxy is None:
+            with self.lock:
+                wait = self.retry_time - time.time()
+            if wait > 0.0:
+                self.proxies.put(None)
+                raise rospy.ServiceException("service [%s] unavailable, retrying connection in %.1f s" % (self.service_name, wait))
+            proxy = rospy.ServiceProxy(self.service_name, self.service_class, persistent=True)
+
+        return proxy
+
 
-    clean_dict(ros_namespace, ros_server, services_dict, idx)
+    # proxies in use while the pool is closed are closed when they come back
+    def release(self, proxy):
+        with self.lock:
+            if not self.closed:
+                self.proxies.put(proxy)
+                return
+        if proxy is not None:
+            proxy.close()
+
+
+    def is_connected(self, proxy):
+        return proxy.transport is not None and not proxy.transport.done
+
+
+    def connection_failed(self):
+        with self.lock:
+            self.backoff = min(max(2.0 * self.backoff, 0.1), self.max_backoff)
+            self.retry_time = time.time() + self.backoff
+        rospy.logwarn("Connection to ROS service '%s' failed, retrying in %.1f s", self.service_name, self.backoff)
+
+
+    def connection_succeeded(self):
+        with self.lock:
+            self.backoff = 0.0
+            self.retry_time = 0.0
+
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+        while True:
+            try:
+                proxy = self.proxies.get_nowait()
+            except Queue.Empty:
+                return
+            if proxy is not None:
+                proxy.close()
 
 
 class OpcUaROSService:
 
     def __init__(self, ros_server, parent, idx, service_name, service_type):
         self.server = ros_server
-        self.parent = parent # self.recursive_create_objects(service_name, idx, parent)
+        self.parent = ros_server.get_folder(parent, service_name)
         self.idx = idx
 
         self.service_name = service_name
@@ -86,18 +218,27 @@ class OpcUaROSService:
         rospy.logdebug("service_type: '%s'", self.service_type)
 
         self.counter = 0
-        self._nodes = {}
+        self.node_ids = []
+
+        # per service timeout and concurrency limit
+        limits = ros_server.services_limits.get(service_name, {})
+        self.timeout = limits.get('timeout', ros_server.services_timeout)
+        if self.timeout <= 0.0:
+            self.timeout = None
+        self.max_calls = limits.get('max_concurrent_calls', ros_server.services_max_concurrent_calls)
+        self.calls_semaphore = threading.BoundedSemaphore(self.max_calls)
         self.expressions = {}
         self._eval_locals = {}
 
-        try:
-            self.srv_class = rosservice.get_service_class_by_name(self.service_name)
-            self.srv_instance = self.srv_class()
-        except rospy.ROSException:
+        # resolved from the known type, without asking the master and the service again
+        self.srv_class = ros_utils.get_service_class(self.service_type)
+        if self.srv_class is None:
             rospy.logfatal("Couldn't find service class for type '%s'", self.service_type)
             return
+        self.srv_instance = self.srv_class()
 
-        self.proxy = rospy.ServiceProxy(self.service_name, rosservice.get_service_class_by_name(self.service_name))
+        # one persistent connection for each call allowed to run at once
+        self.proxies = ServiceProxyPool(self.service_name, self.srv_class, self.max_calls)
 
 
         # for module in (math, random, time):
@@ -107,57 +248,69 @@ class OpcUaROSService:
         # del self._eval_locals['__name__']
         # del self._eval_locals['__doc__']
 
-        # Build the Array of inputs
-        self.req_class = self.srv_class._request_class()
-        self.res_class = self.srv_class._response_class()
-        self.inputs  = ros_utils.ros_msg_to_arguments(self.srv_class._request_class())
-        self.outputs = ros_utils.ros_msg_to_arguments(self.srv_class._response_class())
+        # Build the Array of inputs and outputs, requests are filled and responses
+        # are read following the same layout
+        request_layout = ros_utils.compile_msg_layout(self.srv_class._request_class())
+        response_layout = ros_utils.compile_msg_layout(self.srv_class._response_class())
+        self.request_setters = ros_utils.compile_msg_setters(request_layout)
+        self.response_getters = ros_utils.compile_msg_getters(response_layout)
+        # arguments are named by their path, nested fields with the same slot name stay apart
+        self.inputs  = [ros_utils.slot_msg_to_argument(ros_utils.layout_argument_name(path), slot_type) for path, slot_name, slot_type in request_layout]
+        self.outputs = [ros_utils.slot_msg_to_argument(ros_utils.layout_argument_name(path), slot_type) for path, slot_name, slot_type in response_layout]
 
         name = self.service_name
-        qname = self.service_name.split('/')[-1]
-        self.method = self.parent.add_method(ua.NodeId(name, parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                                             ua.QualifiedName(name, parent.nodeid.NamespaceIndex),
-                                             self.call_service, self.inputs, self.outputs)
+        # the method and its argument properties are added in one batch
+        builder = ros_utils.NodeBuilder(ros_server.server)
+        self.method = builder.add_method(self.parent.nodeid,
+                                         ua.NodeId(name, parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
+                                         ua.QualifiedName(name, parent.nodeid.NamespaceIndex),
+                                         self.call_service, self.inputs, self.outputs)
+        try:
+            self.node_ids = builder.commit()
+        except ua.UaStatusCodeError:
+            # the nodes are rolled back, the namespace folders created for them go too
+            ros_server.delete_empty_folders(parent, self.parent)
+            raise
 
         rospy.loginfo("Created OPC-UA Service: %s", self.service_name)
 
 
-    def recursive_create_objects(self, name, idx, parent):
-        hierachy = name.split('/')
+    @uamethod
+    def call_service(self, parent, *input_args):
+        rospy.loginfo("Called OPC-UA Service: %s", self.service_name)
+        rospy.logdebug("OPC-UA InputArguments: %s", input_args)
 
-        if len(hierachy) == 0 or len(hierachy) == 1:
-            return parent
+        if not self.calls_semaphore.acquire(False):
+            rospy.logwarn("Rejected OPC-UA Service call: %s, %d calls already running", self.service_name, self.max_calls)
+            return ua.StatusCode(ua.status_codes.StatusCodes.BadTooManyOperations)
 
-        for name in hierachy:
-            if name != '':
-                try:
-                    node_with_same_name = self.server.find_service_node_with_same_name(name, idx)
-                    rospy.logdebug("node_with_same_name for name: " + str(name) + " is : " + str(node_with_same_name))
-                    if node_with_same_name is not None:
-                        rospy.logdebug("recursive call for same name for: " + name)
-                        return self.recursive_create_objects(ros_server.nextname(hierachy, hierachy.index(name)), idx, node_with_same_name)
-                    else:
-                        new_parent = parent.add_object(ua.NodeId(name, parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                                                       ua.QualifiedName(name, parent.nodeid.NamespaceIndex))
-                        return self.recursive_create_objects(ros_server.nextname(hierachy, hierachy.index(name)), idx, new_parent)
-                except IndexError, common.uaerrors.UaError:
-                    new_parent = parent.add_object(ua.NodeId(name + str(random.randint(0, 10000)), parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                                                   ua.QualifiedName(name, parent.nodeid.NamespaceIndex))
-                    return self.recursive_create_objects(ros_server.nextname(hierachy, hierachy.index(name)), idx, new_parent)
-        return parent
+        # the ROS call runs in the pool, the OPC-UA request waits at most timeout seconds for it
+        call = self.server.services_pool.submit(self.invoke_service, input_args)
+        if not call.wait(self.timeout):
+            rospy.logerr("Timeout of OPC-UA Service: %s after %.1f s", self.service_name, self.timeout)
+            return ua.StatusCode(ua.status_codes.StatusCodes.BadTimeout)
 
+        return call.result
+
+
+    def invoke_service(self, input_args):
+        try:
+            return self.call_proxy(input_args)
+        finally:
+            self.calls_semaphore.release()
 
-    @uamethod
-    def call_service(self, parent, *input_args):
-        rospy.loginfo("Called OPC-UA Service: %s", self.service_name)
-        rospy.logdebug("OPC-UA InputArguments: %s", str(input_args))
 
-        req, input_idx = self.create_service_request(self.srv_class._request_class(), input_args)
-        rospy.logdebug("ROS Request:\n%s", str(req))
+    def call_proxy(self, input_args):
+        if len(input_args) != len(self.request_setters):
+            rospy.logerr("OPC-UA Service: %s expects %d arguments, got %d", self.service_name, len(self.request_setters), len(input_args))
+            return ua.StatusCode(ua.status_codes.StatusCodes.BadInvalidArgument)
+
+        req = self.create_service_request(input_args)
+        rospy.logdebug("ROS Request:\n%s", req)
 
         try:
-            res = self.proxy.call(req)
-            rospy.logdebug("ROS Response:\n%s", str(res))
+            res = self.proxies.call(req)
+            rospy.logdebug("ROS Response:\n%s", res)
         except TypeError as ex:
             rospy.logerr("%s", str(ex))
             return
@@ -171,37 +324,36 @@ class OpcUaROSService:
             rospy.logerr("%s", str(ex))
             return ua.StatusCode(ua.status_codes.StatusCodes.BadInvalidArgument)
 
-        output_args = ros_utils.ros_msg_to_variants(res)
-        rospy.logdebug("OPC-UA OutputArguments: %s", str(output_args))
+        output_args = self.create_output_arguments(res)
+        rospy.logdebug("OPC-UA OutputArguments: %s", output_args)
         return output_args
 
 
-    def create_service_request(self, req, input_args, input_idx=0):
-        for slot_name, slot_type in zip(req.__slots__, req._slot_types):
-            slot_value = getattr(req, slot_name)
+    def create_service_request(self, input_args):
+        # always a fresh request, calls may run concurrently
+        req = self.srv_class._request_class()
+        for (setter, convert), arg in zip(self.request_setters, input_args):
+            if convert is not None and arg is not None:
+                arg = convert(arg)
+            setter(req, arg)
+        return req
 
-            if hasattr(slot_value, '_type'):
-                slot_value, input_idx = self.create_service_request(slot_value, input_args, input_idx)
-                setattr(req, slot_name, slot_value)
-            else:
-                arg = input_args[input_idx]
-                setattr(req, slot_name, arg)
-                input_idx += 1
 
-        return req, input_idx
+    def create_output_arguments(self, res):
+        output_args = []
+        for getter, variant_type, convert in self.response_getters:
+            value = getter(res)
+            if convert is not None:
+                value = convert(value)
+            output_args.append(ua.Variant(value, variant_type))
+        return tuple(output_args)
 
 
-    def recursive_delete_node(self, node):
+    def delete_nodes(self):
         # close ros proxy service
-        self.proxy.close()
-
-        for child in node.get_children():
-            self.recursive_delete_node(child)
-
-            if child in self._nodes:
-                del self._nodes[child]
-
-            self.server.server.delete_nodes([child])
+        self.proxies.close()
 
-        self.server.server.delete_nodes([self.method])
-        ros_server.own_rosnode_cleanup()
+        # delete the method and its arguments in one batch
+        ros_utils.delete_node_ids(self.server.server, self.node_ids)
+        self.node_ids = []
+        self.server.node_cleanup.schedule()
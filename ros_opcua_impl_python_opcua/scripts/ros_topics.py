@@ -1,11 +1,12 @@
 # Thanks to:
 # https://github.com/ros-visualization/rqt_common_plugins/blob/groovy-devel/rqt_topic/src/rqt_topic/topic_widget.py
-import random
+import collections
+import threading
+import time
 import numpy
 
 import rospy
-import roslib
-import roslib.message
+import rospy.numpy_msg
 import rostopic
 from opcua import ua, uamethod
 
@@ -14,218 +15,548 @@ import ros_actions
 import ros_utils
 
 
-# use to not get dict changed during iteration errors
-def clean_dict(ros_namespace, ros_server, topics_dict, idx, clean_all=False):
-    ros_topics = rospy.get_published_topics(namespace=ros_namespace)
-    topic_names = zip(*ros_topics)[0]
-    topic_types = zip(*ros_topics)[1]
+def refresh_topics(ros_server, topics_dict, idx, topics_object, ros_topics, clean_all=False):
+    """
+    Given the published topics of one master snapshot
+    apply only the added and removed topics to the address space,
+    return True if anything changed
+    """
+    topic_types = dict(ros_topics)
+
+    removed = set()
+    for topic_name, opcua_topic in topics_dict.items():
+        if clean_all or topic_types.get(topic_name) != opcua_topic.topic_type:
+            removed.add(topic_name)
+
+    added = set()
+    for topic_name in topic_types:
+        if topic_name in ros_server.topics_whitelist and (topic_name not in topics_dict or topic_name in removed):
+            added.add(topic_name)
+    if clean_all:
+        added.clear()
+
+    for topic_name in removed:
+        opcua_topic = topics_dict.pop(topic_name)
+        opcua_topic.delete_nodes()
+        ros_server.delete_empty_folders(topics_object, opcua_topic.parent)
+
+    for topic_name in sorted(added):
+        try:
+            topics_dict[topic_name] = OpcUaROSTopic(ros_server, topics_object, idx, topic_name, topic_types[topic_name],
+                                                    ros_server.topics_lazy)
+        except ua.UaStatusCodeError as ex:
+            rospy.logerr("Error creating OPC-UA Topic '%s': %s", topic_name, ex)
 
-    to_be_deleted = []
-    for node_name in topics_dict:
+    return bool(removed or added)
 
-        if (node_name not in topic_names) or (clean_all == True):
 
-            topics_dict[node_name].recursive_delete_node(ros_server.server.get_node(ua.NodeId(node_name, idx)))
+# Used to delete obsolete topics
+def number_of_subscribers(node_name, topics_dict):
+    # rosout only has one subscriber/publisher at all times, so ignore.
+    if node_name != "/rosout":
+        ret = topics_dict[node_name].subscriber.get_num_connections()
+    else:
+        ret = 2
+    return ret
 
-            to_be_deleted.append(node_name)
 
-    for node_name in to_be_deleted:
-        del topics_dict[node_name]
+def create_topic_filter(settings, callback):
+    if settings is None:
+        return None
 
+    mode = settings.get('mode', 'keep_latest')
+    if mode not in ('keep_latest', 'drop_intermediate'):
+        rospy.logerr("Unknown filter mode '%s' for topic '%s', using 'keep_latest'", mode, settings.get('topic'))
+        mode = 'keep_latest'
+
+    deadband_type = settings.get('deadband_type', 'absolute')
+    if deadband_type not in ('absolute', 'percent'):
+        rospy.logerr("Unknown deadband type '%s' for topic '%s', using 'absolute'", deadband_type, settings.get('topic'))
+        deadband_type = 'absolute'
+
+    return TopicFilter(callback, settings.get('max_rate', 0.0), settings.get('deadband'), deadband_type, mode == 'keep_latest')
+
+
+class TopicFilter:
+
+    def __init__(self, callback, max_rate=0.0, deadband=None, deadband_type='absolute', keep_latest=True):
+        self.callback = callback
+        self.period = 1.0 / max_rate if max_rate > 0.0 else 0.0
+        self.deadband = deadband
+        self.percent = deadband_type == 'percent'
+        self.keep_latest = keep_latest
+
+        self.lock = threading.Lock()
+        self.last_time = 0.0
+        self.pending = None
+        self.timer = None
+
+
+    def put(self, msg):
+        if self.period > 0.0:
+            with self.lock:
+                now = time.time()
+                wait = self.last_time + self.period - now
+                if wait > 0.0:
+                    # too early, keep the message for later or drop it
+                    if self.keep_latest:
+                        self.pending = msg
+                        if self.timer is None:
+                            self.timer = threading.Timer(wait, self.flush)
+                            self.timer.daemon = True
+                            self.timer.start()
+                    return
+                self.last_time = now
+                self.pending = None
+
+        self.callback(msg)
+
+
+    def flush(self):
+        with self.lock:
+            msg = self.pending
+            self.pending = None
+            self.timer = None
+            if msg is None:
+                return
+            self.last_time = time.time()
 
-def refresh_topics(ros_namespace, ros_server, topics_dict, idx, topics_object):
-    ros_topics = rospy.get_published_topics(namespace=ros_namespace)
+        self.callback(msg)
 
-    for topic_name, topic_type in ros_topics:
 
-        if topic_name not in ros_server.topics_whitelist:
-            continue
+    def stop(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            self.pending = None
 
-        if topic_name not in topics_dict or topics_dict[topic_name] is None:
-            # splits = topic_name.split('/')
-            # if splits[-1] not in ["status", "cancel", "goal", "feedback", "result"]:
-                # rospy.loginfo("Ignoring normal topics for debugging...")
-            opcua_topic = OpcUaROSTopic(ros_server, topics_object, idx, topic_name, topic_type)
-            topics_dict[topic_name] = opcua_topic
 
-        # elif number_of_subscribers(topic_name, topics_dict) <= 1 and "rosout" not in node_name:
-        #     topics_dict[topic_name].recursive_delete_node(ros_server.server.get_node(ua.NodeId(topic_name, idx_topics)))
-        #     del topics_dict[topic_name]
-        #     ros_server.own_rosnode_cleanup()
+    # values still in the deadband of their last written value are replaced by it,
+    # each leaf is decided on its own, a moving header.seq doesn't let all others through
+    def apply_deadband(self, values, last_values):
+        if self.deadband is None:
+            return values
 
-    clean_dict(ros_namespace, ros_server, topics_dict, idx)
+        return [last if self.value_in_deadband(value, last) else value
+                for value, last in zip(values, last_values)]
 
 
-# Used to delete obsolete topics
-def number_of_subscribers(node_name, topics_dict):
-    # rosout only has one subscriber/publisher at all times, so ignore.
-    if node_name != "/rosout":
-        ret = topics_dict[node_name].subscriber.get_num_connections()
-    else:
-        ret = 2
-    return ret
+    def value_in_deadband(self, value, last):
+        if last is None:
+            return False
+
+        if isinstance(value, numpy.ndarray):
+            if not isinstance(last, numpy.ndarray) or value.shape != last.shape:
+                return False
+            if value.dtype.kind in 'iuf':
+                diff = numpy.abs(value.astype(numpy.float64) - last)
+                if self.percent:
+                    return bool(numpy.all(diff <= numpy.abs(last) * self.deadband / 100.0))
+                return bool(numpy.all(diff <= self.deadband))
+            return numpy.array_equal(value, last)
+
+        if type(value) in (list, tuple):
+            if len(value) != len(last):
+                return False
+            for item, last_item in zip(value, last):
+                if not self.value_in_deadband(item, last_item):
+                    return False
+            return True
+
+        if type(value) in (int, long, float) and type(last) in (int, long, float):
+            if self.percent:
+                return abs(value - last) <= abs(last) * self.deadband / 100.0
+            return abs(value - last) <= self.deadband
+
+        return value == last
+
+
+class TopicWriter:
+
+    def __init__(self, num_threads=1, queue_size=100):
+        self.queue_size = queue_size
+        self.condition = threading.Condition()
+
+        # latest message per topic, a newer message replaces the pending one
+        self.slots = {}
+        self.ready = collections.deque()
+        self.busy = set()
+        self.running = False
+
+        self.written = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+        self.threads = []
+        for index in range(num_threads):
+            thread = threading.Thread(target=self.run, name="opcua_topic_writer_%d" % index)
+            thread.daemon = True
+            self.threads.append(thread)
+
+
+    def start(self):
+        self.running = True
+        for thread in self.threads:
+            thread.start()
+
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+
+    def put(self, topic, msg):
+        with self.condition:
+            if topic in self.slots:
+                self.slots[topic] = msg
+                self.coalesced += 1
+                return
+
+            if len(self.slots) >= self.queue_size:
+                self.dropped += 1
+                return
+
+            self.slots[topic] = msg
+            # a busy topic is queued again by its worker once it is done
+            if topic not in self.busy:
+                self.ready.append(topic)
+                self.condition.notify()
+
+
+    def discard(self, topic):
+        with self.condition:
+            if topic in self.slots:
+                del self.slots[topic]
+                self.dropped += 1
+                if topic in self.ready:
+                    self.ready.remove(topic)
+
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.running and not self.ready:
+                    self.condition.wait()
+                if not self.running:
+                    return
+                topic = self.ready.popleft()
+                msg = self.slots.pop(topic)
+                self.busy.add(topic)
+
+            try:
+                topic.update_node_value(msg)
+            except Exception as ex:
+                rospy.logerr("Error while updating OPC-UA topic '%s': %s", topic.topic_name, ex)
+
+            with self.condition:
+                self.busy.discard(topic)
+                self.written += 1
+                if topic in self.slots:
+                    self.ready.append(topic)
+                    self.condition.notify()
+
+
+class TopicDemand:
+    """
+    Tracks the interest of OPC-UA clients in topics by hooking
+    the python-opcua address space, browsing a lazy topic
+    materializes it and the monitored values of a topic keep
+    its ROS subscription alive
+    """
+
+    def __init__(self, server, idle_time=60.0):
+        self.idle_time = idle_time
+
+        self.lock = threading.Lock()
+        # node id -> topic
+        self.topics = {}
+        # monitored item handle -> topic
+        self.handles = {}
+
+        iserver = server.iserver
+        self._browse = iserver.view_service.browse
+        self._add_datachange_callback = iserver.aspace.add_datachange_callback
+        self._delete_datachange_callback = iserver.aspace.delete_datachange_callback
+        iserver.view_service.browse = self.browse
+        iserver.aspace.add_datachange_callback = self.add_datachange_callback
+        iserver.aspace.delete_datachange_callback = self.delete_datachange_callback
+
+
+    def register(self, topic, node_ids=None):
+        with self.lock:
+            for nodeid in node_ids if node_ids is not None else topic.node_ids:
+                self.topics[nodeid] = topic
+
+
+    def unregister(self, topic):
+        with self.lock:
+            for nodeid in topic.node_ids:
+                self.topics.pop(nodeid, None)
+
+
+    def find_topic(self, nodeid, prefix=False):
+        with self.lock:
+            topic = self.topics.get(nodeid)
+            if topic is not None or not prefix or not isinstance(nodeid.Identifier, basestring):
+                return topic
+
+            # field node of a topic not materialized yet, look for its topic object
+            identifier = nodeid.Identifier
+            while topic is None:
+                cut = max(identifier.rfind('/'), identifier.rfind('['), identifier.rfind('.'))
+                if cut <= 0:
+                    break
+                identifier = identifier[:cut]
+                topic = self.topics.get(ua.NodeId(identifier, nodeid.NamespaceIndex, ua.NodeIdType.String))
+            return topic
+
+
+    def browse(self, params):
+        for desc in params.NodesToBrowse:
+            topic = self.find_topic(desc.NodeId)
+            if topic is not None and not topic.materialized:
+                topic.materialize()
+        return self._browse(params)
+
+
+    def add_datachange_callback(self, nodeid, attr, callback):
+        topic = self.find_topic(nodeid, prefix=True)
+        if topic is not None and not topic.materialized:
+            topic.materialize()
+
+        result, handle = self._add_datachange_callback(nodeid, attr, callback)
+        # only monitored values depend on the ROS messages
+        if topic is not None and result.is_good() and attr == ua.AttributeIds.Value:
+            with self.lock:
+                self.handles[handle] = topic
+            topic.monitored_item_added()
+        return result, handle
+
+
+    def delete_datachange_callback(self, handle):
+        with self.lock:
+            topic = self.handles.pop(handle, None)
+        self._delete_datachange_callback(handle)
+        if topic is not None:
+            topic.monitored_item_removed()
 
 
 class OpcUaROSTopic:
 
-    def __init__(self, ros_server, parent, idx, topic_name, topic_type):
+    def __init__(self, ros_server, parent, idx, topic_name, topic_type, lazy=False):
         self.server = ros_server
-        self.parent = parent # self.recursive_create_objects(parent, idx, topic_name)
+        self.parent = ros_server.get_folder(parent, topic_name)
         self.idx = idx
         self.nodes = {}
+        self.node_ids = []
 
         self.topic_name = topic_name
         self.topic_type = topic_type
 
-        try:
-            self.msg_class = roslib.message.get_message_class(topic_type)
-            self.msg_instance = self.msg_class()
-        except rospy.ROSException:
+        # guards materialization and the ROS subscription, changed from OPC-UA requests
+        self.lock = threading.Lock()
+        self.materialized = False
+        self.deleted = False
+        self.subscriber = None
+        self.publisher = None
+        self.monitored_items = 0
+        self.idle_timer = None
+        self.update_plan = []
+        self.update_lock = threading.Lock()
+        self.last_values = []
+        self.filter = None
+
+        self.msg_class = ros_utils.get_message_class(topic_type)
+        self.message_type = ros_server.message_types.get(topic_type)
+        if self.message_type is None:
             rospy.logfatal("Couldn't find message class for type '%s'", topic_type)
             return
+        self.msg_instance = self.msg_class()
+
+        self.filter = create_topic_filter(ros_server.topics_filters.get(topic_name), self.write_message)
+
+        # instantiate the object type of the message and add the whole node tree of the topic in one batch,
+        # a lazy topic only gets its object until a client browses or monitors it
+        builder = ros_utils.NodeBuilder(ros_server.server)
+        self.nodes = self.message_type.instantiate(builder, self.parent.nodeid, self.topic_name, children=not lazy)
+        topic_id = ua.NodeId(self.topic_name, idx, ua.NodeIdType.String)
+        builder.add_property(topic_id, ua.NodeId(self.topic_name + ".Type", idx),
+                             ua.QualifiedName("Type", idx),
+                             ua.Variant(topic_type, ua.VariantType.String), ua.NodeId(ua.ObjectIds.String))
+        if not lazy:
+            self.add_update_method(builder)
+        try:
+            self.node_ids = builder.commit()
+        except ua.UaStatusCodeError:
+            # the nodes are rolled back, the namespace folders created for them go too
+            ros_server.delete_empty_folders(parent, self.parent)
+            raise
+
+        # the ROS subscription of an on demand topic follows its monitored items
+        self.on_demand = ros_server.topics_on_demand
+        if ros_server.topics_demand is not None:
+            ros_server.topics_demand.register(self)
+
+        if lazy:
+            rospy.loginfo("Created lazy OPC-UA Topic: %s", self.topic_name)
+        else:
+            self.materialized = True
+            self.compile_update_plan()
+            self.advertise()
+            if not self.on_demand:
+                self.subscribe()
+            rospy.loginfo("Created OPC-UA Topic: %s", self.topic_name)
 
-        self.recursive_create_node(self.parent, idx, self.topic_name, self.topic_type, self.msg_instance, True)
-
-        self.subscriber = rospy.Subscriber(self.topic_name, roslib.message.get_message_class(topic_type), self.message_callback)
-        self.publisher  = rospy.Publisher(self.topic_name, roslib.message.get_message_class(topic_type), queue_size=1)
-
-        rospy.loginfo("Created OPC-UA Topic: %s", self.topic_name)
-
-
-    def recursive_create_objects(self, parent, idx, topic_name):
-        hierachy = topic_name.split('/')
-        if len(hierachy) == 0 or len(hierachy) == 1:
-            return parent
-
-        for name in hierachy:
-            if name != '':
-                try:
-                    node_with_same_name = self.server.find_topics_node_with_same_name(name, idx)
-                    if node_with_same_name is not None:
-                        return self.recursive_create_objects(node_with_same_name, idx, ros_server.nextname(hierachy, hierachy.index(name)))
-                    else:
-                        child = parent.add_object(
-                            ua.NodeId(name, parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                            ua.QualifiedName(name, parent.nodeid.NamespaceIndex))
-                        return self.recursive_create_objects(child, idx, ros_server.nextname(hierachy, hierachy.index(name)))
-                except IndexError, common.UaError:
-                    # if for some reason 2 services with exactly same name are created use hack>: add random int, prob to hit two
-                    # same ints 1/10000, should be sufficient
-                    child = parent.add_object(
-                        ua.NodeId(name + str(random.randint(0, 10000)), parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                        ua.QualifiedName(name, parent.nodeid.NamespaceIndex))
-                    return self.recursive_create_objects(child, idx, ros_server.nextname(hierachy, hierachy.index(name)))
-
-        return parent
-
-
-    def recursive_create_node(self, parent, idx, name, type_name, msg, top_level=False):
-        qname = name.split('/')[-1]
-        # if '[' in topic_text:
-        #     topic_text = topic_text[topic_text.index('['):]
-
-        if hasattr(msg, '__slots__') and hasattr(msg, '_slot_types'):
-            # compley type
-            child = parent.add_object(ua.NodeId(name, parent.nodeid.NamespaceIndex, ua.NodeIdType.String),
-                                      ua.QualifiedName(name, parent.nodeid.NamespaceIndex))
-            #
-            child.add_property(ua.NodeId(name + ".Type", idx),
-                               ua.QualifiedName("Type", parent.nodeid.NamespaceIndex), type_name)
-            #
-            if top_level:
-                child.add_method(ua.NodeId(name + ".Update", parent.nodeid.NamespaceIndex),
-                                 ua.QualifiedName("Update", parent.nodeid.NamespaceIndex),
-                                 self.opcua_update_callback, [], [])
-            #
-            for slot_name, slot_type in zip(msg.__slots__, msg._slot_types):
-                self.recursive_create_node(child, idx, name + '/' + slot_name, slot_type, getattr(msg, slot_name))
-            #
-            self.nodes[name] = child
 
-        else:
+    def add_update_method(self, builder):
+        topic_id = ua.NodeId(self.topic_name, self.idx, ua.NodeIdType.String)
+        builder.add_method(topic_id, ua.NodeId(self.topic_name + ".Update", self.idx),
+                           ua.QualifiedName("Update", self.idx),
+                           self.opcua_update_callback, [], [])
 
-            base_type_str, array_size = ros_utils.extract_array_info(type_name)
 
-            try:
-                base_class = roslib.message.get_message_class(base_type_str)
-                base_instance = base_class()
-            except (ValueError, TypeError):
-                base_instance = None
-
-            if array_size is not None and hasattr(base_instance, '__slots__'):
-                for index in range(array_size):
-                    self.recursive_create_node(parent, idx, name + '[%d]' % index, base_type_str, base_instance)
+    def compile_update_plan(self):
+        with self.update_lock:
+            self.update_plan = self.message_type.compile_update_plan(self.nodes, self.topic_name)
+            self.last_values = [None] * len(self.update_plan)
+
+
+    # create the field nodes and the ROS subscription of a lazy topic
+    def materialize(self):
+        with self.lock:
+            if self.materialized or self.deleted:
+                return
+            builder = ros_utils.NodeBuilder(self.server.server)
+            self.nodes.update(self.message_type.instantiate(builder, self.parent.nodeid, self.topic_name, root=False))
+            self.add_update_method(builder)
+            node_ids = builder.commit()
+            self.node_ids.extend(node_ids)
+            self.materialized = True
+
+            self.compile_update_plan()
+            self.advertise()
+            if self.monitored_items > 0 or not self.on_demand:
+                self.subscribe()
+            if self.monitored_items == 0 and self.subscriber is not None:
+                self.start_idle_timer()
+            # registered while deleted can't be set yet, delete_nodes unregisters them all
+            self.server.topics_demand.register(self, node_ids)
+        rospy.loginfo("Materialized OPC-UA Topic: %s", self.topic_name)
+
+
+    def subscribe(self):
+        if self.subscriber is None:
+            # numeric arrays are deserialized as numpy arrays viewing the received buffer
+            if ros_utils.has_numeric_arrays(self.update_plan):
+                subscriber_class = rospy.numpy_msg.numpy_msg(self.msg_class)
             else:
-                node = create_node_variable(parent, name, qname, type_name)
-                node.set_writable(True)
-                self.nodes[name] = node
+                subscriber_class = self.msg_class
+            self.subscriber = rospy.Subscriber(self.topic_name, subscriber_class, self.message_callback)
 
-        return
 
+    def advertise(self):
+        if self.publisher is None:
+            self.publisher = rospy.Publisher(self.topic_name, self.msg_class, queue_size=1)
 
-    def recursive_delete_node(self, node):
-        # Unsubscribe OPC-UA node from ros topic
-        self.publisher.unregister()
-        self.subscriber.unregister()
 
-        # delete children
-        for child in node.get_children():
-            self.recursive_delete_node(child)
-            if child in self.nodes:
-                del self.nodes[child]
-            self.server.server.delete_nodes([child])
+    def monitored_item_added(self):
+        with self.lock:
+            self.monitored_items += 1
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            if self.materialized and not self.deleted and self.subscriber is None:
+                self.subscribe()
+                rospy.logdebug("Subscribed to ROS topic '%s'", self.topic_name)
 
-        # delete the node
-        self.server.server.delete_nodes([node])
 
-        # if parent have no children delete it
-        if len(self.parent.get_children()) == 0:
-            if self.parent != self.server.topics_object:
-                self.server.server.delete_nodes([self.parent])
+    def monitored_item_removed(self):
+        with self.lock:
+            self.monitored_items -= 1
+            if self.monitored_items > 0 or self.deleted or self.subscriber is None:
+                return
+            if self.server.topics_demand.idle_time > 0.0:
+                self.start_idle_timer()
+                return
+            self.subscriber.unregister()
+            self.subscriber = None
+        rospy.logdebug("Released idle ROS topic '%s'", self.topic_name)
 
 
-    def message_callback(self, msg):
-        self.update_node_value(self.topic_name, msg)
+    def start_idle_timer(self):
+        if self.idle_timer is not None:
+            self.idle_timer.cancel()
+        self.idle_timer = threading.Timer(self.server.topics_demand.idle_time, self.release_subscriber)
+        self.idle_timer.daemon = True
+        self.idle_timer.start()
 
 
-    def update_node_value(self, node_name, msg):
+    # no monitored item for the idle time, the nodes keep the last values
+    def release_subscriber(self):
+        with self.lock:
+            self.idle_timer = None
+            if self.monitored_items > 0 or self.subscriber is None:
+                return
+            self.subscriber.unregister()
+            self.subscriber = None
+        rospy.logdebug("Released idle ROS topic '%s'", self.topic_name)
 
-        if hasattr(msg, '__slots__') and hasattr(msg, '_slot_types'):
-            # complex type
-            for slot_name, slot_type in zip(msg.__slots__, msg._slot_types):
-                slot_value = getattr(msg, slot_name)
-                self.update_node_value(node_name + '/' + slot_name, slot_value)
-            return
 
-        if type(msg) in (list, tuple):
+    def delete_nodes(self):
+        # Unsubscribe OPC-UA node from ros topic
+        with self.lock:
+            self.deleted = True
+            if self.idle_timer is not None:
+                self.idle_timer.cancel()
+                self.idle_timer = None
+            if self.publisher is not None:
+                self.publisher.unregister()
+            if self.subscriber is not None:
+                self.subscriber.unregister()
+            self.subscriber = None
+            self.publisher = None
+        if self.filter is not None:
+            self.filter.stop()
+        if self.server.topics_writer is not None:
+            self.server.topics_writer.discard(self)
+        if self.server.topics_demand is not None:
+            self.server.topics_demand.unregister(self)
+
+        # delete all the nodes of the topic in one batch
+        ros_utils.delete_node_ids(self.server.server, self.node_ids)
+        self.node_ids = []
+        self.nodes.clear()
+
 
-            if len(msg) > 0 and hasattr(msg[0], '__slots__'):
-                # complex type array
-                for index, slot in enumerate(msg):
-                    if node_name + '[%d]' % index in self.nodes:
-                        self.update_node_value(node_name + '[%d]' % index, slot)
-                    else:
-                        if node_name in self.nodes:
-                            base_type_str, array_size = ros_utils.extract_array_info(self.nodes[node_name].text(self.type_name))
-                            self.recursive_create_node(self.nodes[node_name], node_name + '[%d]' % index, base_type_str, slot, None)
+    def message_callback(self, msg):
+        if self.filter is not None:
+            self.filter.put(msg)
+        else:
+            self.write_message(msg)
 
-                # remove obsolete children
-                if node_name in self.nodes:
 
-                    if len(msg) < len(self.nodes[node_name].get_children()):
+    def write_message(self, msg):
+        if self.server.topics_writer is not None:
+            # hand over to the writer threads, keeps the subscriber thread free
+            self.server.topics_writer.put(self, msg)
+        else:
+            self.update_node_value(msg)
 
-                        for i in range(len(msg), len(self.nodes[node_name].get_children())):
-                            self.recursive_delete_node(self.nodes[node_name + '[%d]' % i])
-                            del self.nodes[node_name + '[%d]' % i]
-                return
 
-        # simple type or simple type array
-        if node_name in self.nodes and self.nodes[node_name] is not None:
-            node = self.nodes[node_name]
-            if type(msg) is tuple:          ##
-                msg = list(msg)             ##
-            dv = ua.Variant(msg, node.get_data_type_as_variant_type())
-            node.set_value(dv)
+    def update_node_value(self, msg):
+        values = [getter(msg) for getter, node, variant_type, convert in self.update_plan]
+
+        with self.update_lock:
+            # values within the deadband keep their last written value and aren't written
+            if self.filter is not None:
+                values = self.filter.apply_deadband(values, self.last_values)
+
+            ros_utils.write_changed_values(self.server.server, self.update_plan, values, self.last_values)
+            self.last_values = values
 
 
     @uamethod
@@ -274,90 +605,3 @@ def correct_type(node, type_msg):
         rospy.logerr("can't convert: " + str(node.get_data_value.Value))
         return None
     return result
-
-
-def create_node_variable(parent, name, qname, type_name):
-    rospy.logdebug("Creating node variable: '%s' of type: '%s'", name, type_name)
-
-    base_type, array_size = ros_utils.extract_array_info(type_name)
-
-    if base_type in ['bool']:
-        if array_size is None:
-            dv = ua.Variant(False, ua.VariantType.Boolean)
-        else:
-            dv = ua.Variant([], ua.VariantType.Boolean)
-        dt = ua.NodeId(ua.ObjectIds.Boolean, 0)
-    elif base_type in ['int8']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.SByte)
-        else:
-            dv = ua.Variant([], ua.VariantType.SByte)
-        dt = ua.NodeId(ua.ObjectIds.SByte, 0)
-    elif base_type in ['byte', 'uint8']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.Byte)
-        else:
-            dv = ua.Variant([], ua.VariantType.Byte)
-        dt = ua.NodeId(ua.ObjectIds.Byte, 0)
-    elif base_type in ['int16']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.Int16)
-        else:
-            dv = ua.Variant([], ua.VariantType.Int16)
-        dt = ua.NodeId(ua.ObjectIds.Int16, 0)
-    elif base_type in ['uint16']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.UInt16)
-        else:
-            dv = ua.Variant([], ua.VariantType.UInt16)
-        dt = ua.NodeId(ua.ObjectIds.UInt16, 0)
-    elif base_type in ['int', 'int32']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.Int32)
-        else:
-            dv = ua.Variant([], ua.VariantType.Int32)
-        dt = ua.NodeId(ua.ObjectIds.Int32, 0)
-    elif base_type in ['uint32']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.UInt32)
-        else:
-            dv = ua.Variant([], ua.VariantType.UInt32)
-        dt = ua.NodeId(ua.ObjectIds.UInt32, 0)
-    elif base_type in ['int64']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.Int64)
-        else:
-            dv = ua.Variant([], ua.VariantType.Int64)
-        dt = ua.NodeId(ua.ObjectIds.Int64, 0)
-    elif base_type in ['uint64']:
-        if array_size is None:
-            dv = ua.Variant(0, ua.VariantType.UInt64)
-        else:
-            dv = ua.Variant([], ua.VariantType.UInt64)
-        dt = ua.NodeId(ua.ObjectIds.UInt64, 0)
-    elif base_type in ['float', 'float32', 'float64']:
-        if array_size is None:
-            dv = ua.Variant(0.0, ua.VariantType.Float)
-        else:
-            dv = ua.Variant([], ua.VariantType.Float)
-        dt = ua.NodeId(ua.ObjectIds.Float, 0)
-    elif base_type in ['double']:
-        if array_size is None:
-            dv = ua.Variant(0.0, ua.VariantType.Double)
-        else:
-            dv = ua.Variant([], ua.VariantType.Double)
-        dt = ua.NodeId(ua.ObjectIds.Double, 0)
-    elif base_type in ['string']:
-        if array_size is None:
-            dv = ua.Variant('', ua.VariantType.String)
-        else:
-            dv = ua.Variant([], ua.VariantType.String)
-        dt = ua.NodeId(ua.ObjectIds.String, 0)
-    else:
-        rospy.logerr("Can't create node variable of type '%s'", str(type_name))
-        return None
-
-    node = parent.add_variable(ua.NodeId(name, parent.nodeid.NamespaceIndex),
-                               ua.QualifiedName(qname, parent.nodeid.NamespaceIndex),
-                               val=dv, datatype=dt)
-    return node
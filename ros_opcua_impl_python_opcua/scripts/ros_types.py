@@ -0,0 +1,257 @@
+import threading
+
+# ROS
+import rospy
+# python-opcua
+from opcua import ua
+
+import ros_utils
+
+
+class MessageType:
+    """
+    Node layout of a ROS message type generated once
+    and shared by all its instances, entries are
+    (suffix, parent suffix, browse name, type name, object type)
+    in creation order, object type is None for variables
+    """
+
+    def __init__(self, type_name, type_id):
+        self.type_name = type_name
+        self.type_id = type_id
+        self.md5sum = None
+        self.entries = []
+        # (suffix, path, type name) of the variables
+        self.leaves = []
+
+
+    def instantiate(self, builder, parent_id, name, organizes=True, root=True, children=True, qname=None):
+        """
+        Add the nodes of an instance named name to the builder,
+        root and children select the instance object and its
+        field nodes, return the dict of node name -> node
+        """
+        idx = parent_id.NamespaceIndex
+        nodes = {}
+        if root:
+            nodes[name] = builder.add_object(parent_id, ua.NodeId(name, idx, ua.NodeIdType.String),
+                                             ua.QualifiedName(qname or name, idx), organizes, self.type_id)
+        if not children:
+            return nodes
+
+        for suffix, parent_suffix, qname, type_name, type_id in self.entries:
+            node_parent_id = ua.NodeId(name + parent_suffix, idx, ua.NodeIdType.String)
+            node_id = ua.NodeId(name + suffix, idx, ua.NodeIdType.String)
+            if type_id is not None:
+                nodes[name + suffix] = builder.add_object(node_parent_id, node_id, ua.QualifiedName(qname, idx),
+                                                          type_definition=type_id)
+            else:
+                variant, data_type = default_variant(type_name)
+                nodes[name + suffix] = builder.add_variable(node_parent_id, node_id, ua.QualifiedName(qname, idx),
+                                                            variant, data_type, writable=True)
+        return nodes
+
+
+    def compile_update_plan(self, nodes, name):
+        """
+        Return the flat list of update plan entries,
+        one for every leaf variable node found in nodes,
+        without walking the message again
+        """
+        plan = []
+        for suffix, path, type_name in self.leaves:
+            node = nodes.get(name + suffix)
+            if node is None:
+                rospy.logdebug("No node for '%s', skipping it in update plan", name + suffix)
+                continue
+            plan.append(ros_utils.make_plan_entry(path, node, type_name))
+        return plan
+
+
+class MessageTypes:
+    """
+    One OPC-UA ObjectType for each ROS message type,
+    generated on first use and cached for the lifetime
+    of the server, layouts loaded from disk are reused
+    while the MD5 sum of the message is unchanged
+    """
+
+    def __init__(self, server, idx):
+        self.server = server
+        self.idx = idx
+        self.types = {}
+        # type name -> layout loaded from disk, not created yet
+        self.cached = {}
+        self.lock = threading.RLock()
+
+
+    def get(self, type_name):
+        """
+        Return the MessageType of a ROS message type,
+        None if there is no message class for it
+        """
+        with self.lock:
+            try:
+                return self.types[type_name]
+            except KeyError:
+                pass
+
+            msg_class = ros_utils.get_message_class(type_name)
+            if msg_class is None:
+                rospy.logerr("Couldn't find message class for type '%s'", type_name)
+                return None
+
+            message_type = None
+            cached = self.cached.pop(type_name, None)
+            if cached is not None and cached['md5sum'] == msg_class._md5sum:
+                message_type = self.load_type(type_name, cached)
+            if message_type is None:
+                message_type = self.create_type(type_name, msg_class())
+            message_type.md5sum = msg_class._md5sum
+
+            self.create_object_type(message_type)
+            self.types[type_name] = message_type
+            return message_type
+
+
+    def create_type(self, type_name, msg):
+        rospy.logdebug("Creating OPC-UA ObjectType for '%s'", type_name)
+        message_type = MessageType(type_name, ua.NodeId(type_name, self.idx, ua.NodeIdType.String))
+        for slot_name, slot_type in zip(msg.__slots__, msg._slot_types):
+            self.add_slot(message_type, '', (), slot_name, slot_type, getattr(msg, slot_name))
+        return message_type
+
+
+    def add_slot(self, message_type, parent_suffix, parent_path, slot_name, slot_type, slot_value):
+        suffix = parent_suffix + '/' + slot_name
+        path = parent_path + (slot_name,)
+
+        if hasattr(slot_value, '__slots__') and hasattr(slot_value, '_slot_types'):
+            # complex type, its children come from its own type
+            self.add_component(message_type, parent_suffix, suffix, path, slot_name, slot_type)
+            return
+
+        base_type_str, array_size = ros_utils.extract_array_info(slot_type)
+        if array_size is not None and ros_utils.get_message_class(base_type_str) is not None:
+            # complex type array, only fixed size arrays have nodes
+            for index in range(array_size):
+                self.add_component(message_type, parent_suffix, suffix + '[%d]' % index, path + (index,),
+                                   slot_name + '[%d]' % index, base_type_str)
+            return
+
+        # simple type or simple type array
+        variant, data_type = default_variant(slot_type)
+        if variant is None:
+            rospy.logerr("Can't create node variable of type '%s'", str(slot_type))
+            return
+
+        message_type.entries.append((suffix, parent_suffix, slot_name, slot_type, None))
+        message_type.leaves.append((suffix, path, slot_type))
+
+
+    def add_component(self, message_type, parent_suffix, suffix, path, qname, type_name):
+        component_type = self.get(type_name)
+        if component_type is None:
+            return
+
+        message_type.entries.append((suffix, parent_suffix, qname, type_name, component_type.type_id))
+        for entry_suffix, entry_parent_suffix, entry_qname, entry_type_name, entry_type_id in component_type.entries:
+            message_type.entries.append((suffix + entry_suffix, suffix + entry_parent_suffix,
+                                         entry_qname, entry_type_name, entry_type_id))
+        for leaf_suffix, leaf_path, leaf_type_name in component_type.leaves:
+            message_type.leaves.append((suffix + leaf_suffix, path + leaf_path, leaf_type_name))
+
+
+    def create_object_type(self, message_type):
+        """
+        Add the ObjectType node of a message type, the direct
+        children of the message are its mandatory instance declarations
+        """
+        builder = ros_utils.NodeBuilder(self.server)
+        type_id = message_type.type_id
+        builder.add_object_type(ua.NodeId(ua.ObjectIds.BaseObjectType), type_id,
+                                ua.QualifiedName(message_type.type_name, self.idx))
+
+        for suffix, parent_suffix, qname, type_name, component_type_id in message_type.entries:
+            if parent_suffix != '':
+                continue
+            node_id = ua.NodeId(message_type.type_name + suffix, self.idx, ua.NodeIdType.String)
+            if component_type_id is not None:
+                builder.add_object(type_id, node_id, ua.QualifiedName(qname, self.idx),
+                                   type_definition=component_type_id)
+            else:
+                variant, data_type = default_variant(type_name)
+                builder.add_variable(type_id, node_id, ua.QualifiedName(qname, self.idx),
+                                     variant, data_type, writable=True)
+            builder.add_mandatory(node_id)
+
+        builder.commit()
+
+
+    def load_type(self, type_name, cached):
+        """
+        Rebuild a MessageType from its layout saved on disk,
+        None if one of its component types is gone
+        """
+        message_type = MessageType(type_name, ua.NodeId(type_name, self.idx, ua.NodeIdType.String))
+        for suffix, parent_suffix, qname, entry_type_name, component_type_name in cached['entries']:
+            component_type_id = None
+            if component_type_name is not None:
+                component_type = self.get(str(component_type_name))
+                if component_type is None:
+                    return None
+                component_type_id = component_type.type_id
+            message_type.entries.append((str(suffix), str(parent_suffix), str(qname), str(entry_type_name), component_type_id))
+        for suffix, path, leaf_type_name in cached['leaves']:
+            path = tuple(step if isinstance(step, int) else str(step) for step in path)
+            message_type.leaves.append((str(suffix), path, str(leaf_type_name)))
+        return message_type
+
+
+    def load(self, cached):
+        """
+        Given the dumped layouts of a previous run, keep them
+        to be used instead of walking the message classes
+        """
+        with self.lock:
+            self.cached = dict(cached)
+
+
+    def dump(self):
+        """
+        Return the layouts of the created types
+        as plain lists, keyed by type name
+        """
+        with self.lock:
+            dumped = {}
+            for type_name, message_type in self.types.items():
+                entries = []
+                for suffix, parent_suffix, qname, entry_type_name, component_type_id in message_type.entries:
+                    component_type_name = None
+                    if component_type_id is not None:
+                        component_type_name = component_type_id.Identifier
+                    entries.append([suffix, parent_suffix, qname, entry_type_name, component_type_name])
+                dumped[type_name] = {
+                    'md5sum': message_type.md5sum,
+                    'entries': entries,
+                    'leaves': [[suffix, list(path), leaf_type_name] for suffix, path, leaf_type_name in message_type.leaves],
+                }
+            # layouts of types not used in this run are kept for the next one
+            for type_name, cached in self.cached.items():
+                dumped.setdefault(type_name, cached)
+            return dumped
+
+
+def default_variant(type_name):
+    """
+    Given a builtin type name return the default
+    value variant and data type of its node,
+    None if it has no OPC-UA mapping
+    """
+    type_info, array_size = ros_utils.get_type_info(type_name)
+    if type_info is None or type_info.variant_type is None:
+        return None, None
+
+    if array_size is None:
+        return ua.Variant(type_info.default, type_info.variant_type), type_info.data_type
+    return ua.Variant([], type_info.variant_type), type_info.data_type
@@ -1,40 +1,526 @@
+import re
+import collections
+import operator
+from datetime import datetime
+
+import numpy
+
 # ROS
 import rospy
+import roslib.message
 # python-opcua
 from opcua import ua
 
 
+# OPC-UA mapping of a ROS builtin type, converter casts a python value to the ROS type
+# (None if no cast is needed) and dtype is the numpy type matching the variant type of array values
+RosType = collections.namedtuple('RosType', ['variant_type', 'data_type', 'default', 'converter', 'dtype'])
+
+
+def _ros_type(variant_type, object_id, default, converter, dtype=None):
+    return RosType(variant_type, ua.NodeId(object_id, 0), default, converter, dtype)
+
+
+ROS_TYPES = {
+    'bool':    _ros_type(ua.VariantType.Boolean, ua.ObjectIds.Boolean, False, bool, numpy.bool_),
+    'int8':    _ros_type(ua.VariantType.SByte, ua.ObjectIds.SByte, 0, int, numpy.int8),
+    'byte':    _ros_type(ua.VariantType.Byte, ua.ObjectIds.Byte, 0, int, numpy.uint8),
+    'char':    _ros_type(ua.VariantType.Byte, ua.ObjectIds.Byte, 0, int, numpy.uint8),
+    'uint8':   _ros_type(ua.VariantType.Byte, ua.ObjectIds.Byte, 0, int, numpy.uint8),
+    'int16':   _ros_type(ua.VariantType.Int16, ua.ObjectIds.Int16, 0, int, numpy.int16),
+    'uint16':  _ros_type(ua.VariantType.UInt16, ua.ObjectIds.UInt16, 0, int, numpy.uint16),
+    'int':     _ros_type(ua.VariantType.Int32, ua.ObjectIds.Int32, 0, int, numpy.int32),
+    'int32':   _ros_type(ua.VariantType.Int32, ua.ObjectIds.Int32, 0, int, numpy.int32),
+    'uint32':  _ros_type(ua.VariantType.UInt32, ua.ObjectIds.UInt32, 0, int, numpy.uint32),
+    'int64':   _ros_type(ua.VariantType.Int64, ua.ObjectIds.Int64, 0, long, numpy.int64),
+    'uint64':  _ros_type(ua.VariantType.UInt64, ua.ObjectIds.UInt64, 0, long, numpy.uint64),
+    'float':   _ros_type(ua.VariantType.Float, ua.ObjectIds.Float, 0.0, float, numpy.float32),
+    'float32': _ros_type(ua.VariantType.Float, ua.ObjectIds.Float, 0.0, float, numpy.float32),
+    'float64': _ros_type(ua.VariantType.Float, ua.ObjectIds.Float, 0.0, float, numpy.float32),
+    'double':  _ros_type(ua.VariantType.Double, ua.ObjectIds.Double, 0.0, float, numpy.float64),
+    'string':  _ros_type(ua.VariantType.String, ua.ObjectIds.String, '', None),
+    # only usable as method argument, there is no variant conversion for time
+    'time':    _ros_type(None, ua.ObjectIds.Time, None, None),
+    'Time':    _ros_type(None, ua.ObjectIds.Time, None, None),
+}
+
+# uint8 and char arrays are deserialized by ROS as byte strings,
+# they are passed through as a single ByteString value
+BYTES_TYPE = _ros_type(ua.VariantType.ByteString, ua.ObjectIds.ByteString, b'', bytes)
+BYTES_BASE_TYPES = ('uint8', 'char')
+
+_array_info_cache = {}
+_message_class_cache = {}
+_service_class_cache = {}
+
+
 def extract_array_info(type_str):
     """
-    Given a the type name
+    Given the type name
     return the base type
     and eventyally the array size
     """
+    try:
+        return _array_info_cache[type_str]
+    except KeyError:
+        pass
+
+    base_type_str = type_str
     array_size = None
     if '[' in type_str and type_str[-1] == ']':
-        type_str, array_size_str = type_str.split('[', 1)
+        base_type_str, array_size_str = type_str.split('[', 1)
         array_size_str = array_size_str[:-1]
         if len(array_size_str) > 0:
             array_size = int(array_size_str)
         else:
             array_size = 0
 
-    return type_str, array_size
+    _array_info_cache[type_str] = base_type_str, array_size
+    return base_type_str, array_size
+
+
+def get_message_class(type_str):
+    """
+    Given the type name
+    return the ROS message class,
+    None if it is not a message type
+    """
+    try:
+        return _message_class_cache[type_str]
+    except KeyError:
+        pass
+
+    try:
+        msg_class = roslib.message.get_message_class(type_str)
+    except (ValueError, TypeError):
+        msg_class = None
+
+    _message_class_cache[type_str] = msg_class
+    return msg_class
+
+
+def get_service_class(type_str):
+    """
+    Given the service type name
+    return the ROS service class,
+    None if it is not a service type
+    """
+    try:
+        return _service_class_cache[type_str]
+    except KeyError:
+        pass
+
+    try:
+        srv_class = roslib.message.get_service_class(type_str)
+    except (ValueError, TypeError):
+        srv_class = None
+
+    _service_class_cache[type_str] = srv_class
+    return srv_class
+
+
+def get_type_info(type_str):
+    """
+    Given the type name
+    return the RosType of the base type, None for
+    non builtin types, and eventually the array size
+    """
+    base_type_str, array_size = extract_array_info(type_str)
+    if array_size is not None and base_type_str in BYTES_BASE_TYPES:
+        return BYTES_TYPE, None
+    return ROS_TYPES.get(base_type_str), array_size
+
+
+def make_array_converter(dtype):
+    """
+    Given the numpy type of the target variant
+    return a callable converting array values to the list
+    python-opcua expects, numpy arrays are cast and converted
+    without a python loop over the elements
+    """
+    def convert(value):
+        if isinstance(value, numpy.ndarray):
+            return value.astype(dtype, copy=False).tolist()
+        return list(value)
+
+    return convert
+
+
+def make_getter(path):
+    """
+    Given a path of slot names and array indexes
+    return a callable extracting the value at
+    that path from a message
+    """
+    getters = []
+    attrs = []
+    for step in path:
+        if isinstance(step, int):
+            if attrs:
+                getters.append(operator.attrgetter('.'.join(attrs)))
+                attrs = []
+            getters.append(operator.itemgetter(step))
+        else:
+            attrs.append(step)
+    if attrs:
+        getters.append(operator.attrgetter('.'.join(attrs)))
+
+    if len(getters) == 1:
+        return getters[0]
+
+    def getter(msg):
+        for get in getters:
+            msg = get(msg)
+        return msg
+
+    return getter
+
+
+def make_plan_entry(path, node, type_name):
+    """
+    Return the update plan entry writing
+    the value at path of a message into node
+    """
+    type_info, array_size = get_type_info(type_name)
+    if array_size is None:
+        convert = None
+    elif type_info.dtype is not None:
+        convert = make_array_converter(type_info.dtype)
+    else:
+        convert = list
+    return make_getter(path), node, type_info.variant_type, convert
+
+
+def has_numeric_arrays(plan):
+    for getter, node, variant_type, convert in plan:
+        if convert is not None and convert is not list:
+            return True
+    return False
+
+
+def write_node_values(server, nodes, variants):
+    """
+    Write the variants into the value attribute of the nodes
+    holding the address space lock once for the whole batch,
+    all values share one source timestamp and the data change
+    notifications are sent after the lock is released
+    """
+    aspace = server.iserver.aspace
+    now = datetime.utcnow()
+    callbacks = []
+
+    with aspace._lock:
+        for node, variant in zip(nodes, variants):
+            nodedata = aspace.get(node.nodeid)
+            if nodedata is None or ua.AttributeIds.Value not in nodedata.attributes:
+                continue
+            attval = nodedata.attributes[ua.AttributeIds.Value]
+
+            dv = ua.DataValue(variant)
+            dv.SourceTimestamp = now
+            dv.ServerTimestamp = now
+
+            old = attval.value
+            attval.value = dv
+            # only notify when a value change has happened
+            if old.Value != dv.Value:
+                for handle, callback in attval.datachange_callbacks.items():
+                    callbacks.append((handle, callback, dv))
+
+    for handle, callback, dv in callbacks:
+        try:
+            callback(handle, dv)
+        except Exception as ex:
+            rospy.logerr("Error calling data change callback: %s", ex)
+
+
+class NodeBuilder:
+    """
+    Collect the AddNodesItems of a node tree and add
+    them to the address space in a single batch,
+    if one node fails the whole tree is rolled back
+    """
+
+    def __init__(self, server):
+        self.server = server
+        self.items = []
+        self.method_callbacks = []
+        self.references = []
+        self.node_ids = []
+
+
+    def add_object(self, parent_id, nodeid, qname, organizes=False, type_definition=None):
+        attrs = ua.ObjectAttributes()
+        attrs.EventNotifier = 0
+        self._add_item(parent_id, nodeid, qname, ua.NodeClass.Object, attrs,
+                       ua.ObjectIds.Organizes if organizes else ua.ObjectIds.HasComponent,
+                       type_definition or ua.ObjectIds.BaseObjectType)
+        return self.server.get_node(nodeid)
+
+
+    def add_object_type(self, parent_id, nodeid, qname):
+        attrs = ua.ObjectTypeAttributes()
+        attrs.IsAbstract = False
+        self._add_item(parent_id, nodeid, qname, ua.NodeClass.ObjectType, attrs, ua.ObjectIds.HasSubtype, None)
+        return self.server.get_node(nodeid)
+
+
+    def add_mandatory(self, nodeid):
+        """
+        Mark an instance declaration of an object type
+        as mandatory, the reference is added after the nodes
+        """
+        item = ua.AddReferencesItem()
+        item.SourceNodeId = nodeid
+        item.ReferenceTypeId = ua.NodeId(ua.ObjectIds.HasModellingRule)
+        item.IsForward = True
+        item.TargetNodeId = ua.NodeId(ua.ObjectIds.ModellingRule_Mandatory)
+        item.TargetNodeClass = ua.NodeClass.Object
+        self.references.append(item)
+
+
+    def add_variable(self, parent_id, nodeid, qname, variant, datatype, writable=False, isproperty=False):
+        attrs = ua.VariableAttributes()
+        attrs.DataType = datatype
+        attrs.Value = variant
+        if isinstance(variant.Value, (list, tuple)):
+            attrs.ValueRank = ua.ValueRank.OneDimension
+        else:
+            attrs.ValueRank = ua.ValueRank.Scalar
+        attrs.Historizing = False
+        attrs.AccessLevel = ua.AccessLevel.CurrentRead.mask
+        if writable:
+            attrs.AccessLevel |= ua.AccessLevel.CurrentWrite.mask
+        attrs.UserAccessLevel = attrs.AccessLevel
+        if isproperty:
+            self._add_item(parent_id, nodeid, qname, ua.NodeClass.Variable, attrs,
+                           ua.ObjectIds.HasProperty, ua.ObjectIds.PropertyType)
+        else:
+            self._add_item(parent_id, nodeid, qname, ua.NodeClass.Variable, attrs,
+                           ua.ObjectIds.HasComponent, ua.ObjectIds.BaseDataVariableType)
+        return self.server.get_node(nodeid)
+
+
+    def add_property(self, parent_id, nodeid, qname, variant, datatype):
+        return self.add_variable(parent_id, nodeid, qname, variant, datatype, isproperty=True)
+
+
+    def add_method(self, parent_id, nodeid, qname, callback, inputs, outputs):
+        attrs = ua.MethodAttributes()
+        attrs.Executable = True
+        attrs.UserExecutable = True
+        self._add_item(parent_id, nodeid, qname, ua.NodeClass.Method, attrs, ua.ObjectIds.HasComponent, None)
 
+        for arguments_name, arguments in (("InputArguments", inputs), ("OutputArguments", outputs)):
+            if arguments:
+                self.add_property(nodeid, ua.NodeId(namespaceidx=nodeid.NamespaceIndex),
+                                  ua.QualifiedName(arguments_name, 0),
+                                  ua.Variant(list(arguments), ua.VariantType.ExtensionObject),
+                                  ua.NodeId(ua.ObjectIds.Argument))
 
-def ros_msg_to_arguments(msg):
-    args = []
+        self.method_callbacks.append((nodeid, callback))
+        return self.server.get_node(nodeid)
+
+
+    def _add_item(self, parent_id, nodeid, qname, node_class, attrs, reference_type, type_definition):
+        attrs.Description = ua.LocalizedText(qname.Name)
+        attrs.DisplayName = ua.LocalizedText(qname.Name)
+        attrs.WriteMask = 0
+        attrs.UserWriteMask = 0
+
+        item = ua.AddNodesItem()
+        item.RequestedNewNodeId = nodeid
+        item.BrowseName = qname
+        item.NodeClass = node_class
+        item.ParentNodeId = parent_id
+        item.ReferenceTypeId = ua.NodeId(reference_type)
+        if isinstance(type_definition, ua.NodeId):
+            item.TypeDefinition = type_definition
+        elif type_definition is not None:
+            item.TypeDefinition = ua.NodeId(type_definition)
+        item.NodeAttributes = attrs
+        self.items.append(item)
+
+
+    def commit(self):
+        """
+        Add all the collected nodes in one batch, parents are
+        collected before their children, on failure the
+        added nodes are deleted and the status raised
+        """
+        isession = self.server.iserver.isession
+        results = isession.add_nodes(self.items)
+        self.node_ids = [result.AddedNodeId for result in results if result.StatusCode.is_good()]
+
+        for item, result in zip(self.items, results):
+            if not result.StatusCode.is_good():
+                rospy.logerr("Error adding node '%s': %s, rolling back %d nodes",
+                             item.BrowseName.Name, result.StatusCode.name, len(self.node_ids))
+                delete_node_ids(self.server, self.node_ids)
+                self.node_ids = []
+                result.StatusCode.check()
+
+        if self.references:
+            for result in isession.add_references(self.references):
+                if not result.is_good():
+                    rospy.logwarn("Error adding reference: %s", result.name)
+
+        for nodeid, callback in self.method_callbacks:
+            isession.add_method_callback(nodeid, callback)
+        self.items = []
+        self.method_callbacks = []
+        self.references = []
+        return self.node_ids
+
+
+def delete_node_ids(server, node_ids):
+    """
+    Delete a list of nodes in one batch,
+    children go before their parents
+    """
+    if node_ids:
+        server.delete_nodes([server.get_node(nodeid) for nodeid in reversed(node_ids)])
+
+
+def write_changed_values(server, plan, values, last_values):
+    """
+    Given the values extracted by an update plan write
+    the ones changed since last_values in one batch,
+    unchanged values are neither written nor notified
+    """
+    nodes = []
+    variants = []
+    for (getter, node, variant_type, convert), value, last in zip(plan, values, last_values):
+        if values_equal(value, last):
+            continue
+        if convert is not None:
+            value = convert(value)
+        nodes.append(node)
+        variants.append(ua.Variant(value, variant_type))
+
+    if nodes:
+        write_node_values(server, nodes, variants)
+
+
+def values_equal(value, last):
+    """
+    Cheap equality test of a new and the last written value,
+    identity first, arrays are compared element wise only
+    when their type and length match
+    """
+    if value is last:
+        return True
+    if last is None:
+        return False
+
+    if isinstance(value, numpy.ndarray):
+        return isinstance(last, numpy.ndarray) and value.shape == last.shape and numpy.array_equal(value, last)
+
+    if type(value) in (list, tuple):
+        if type(last) is not type(value) or len(value) != len(last):
+            return False
+
+    return value == last
+
+
+def compile_msg_layout(msg):
+    """
+    Walk the slots of a message instance and return the flat list
+    of (path, slot name, slot type) of its builtin type leaves,
+    the one layout used for method arguments, requests and responses
+    """
+    layout = []
+    _compile_msg_layout(layout, msg, ())
+    return layout
+
+
+def _compile_msg_layout(layout, msg, path):
     for slot_name, slot_type in zip(msg.__slots__, msg._slot_types):
-        rospy.logdebug("converting slot name: '%s' of type '%s' to argument.", slot_name, slot_type)
         slot_value = getattr(msg, slot_name)
+
         if hasattr(slot_value, '_type'):
-            args_to_merge = ros_msg_to_arguments(slot_value)
-            args.extend(args_to_merge)
+            _compile_msg_layout(layout, slot_value, path + (slot_name,))
+            continue
+
+        type_info, array_size = get_type_info(slot_type)
+        if type_info is not None and type_info.variant_type is not None:
+            layout.append((path + (slot_name,), slot_name, slot_type))
+        elif array_size and len(slot_value) > 0 and hasattr(slot_value[0], '_type'):
+            # fixed size complex type array
+            for index, item in enumerate(slot_value):
+                _compile_msg_layout(layout, item, path + (slot_name, index))
         else:
-            arg = slot_msg_to_argument(slot_name, slot_type)
-            args.append(arg)
+            rospy.logwarn("Slot '%s' of type '%s' can't be mapped to OPC-UA, it is left out", slot_name, slot_type)
+
+
+def make_setter(path):
+    """
+    Given a path of slot names and array indexes
+    return a callable setting the value at
+    that path in a message
+    """
+    slot_name = path[-1]
+
+    if len(path) == 1:
+        def setter(msg, value):
+            setattr(msg, slot_name, value)
+    else:
+        get_parent = make_getter(path[:-1])
 
-    return args
+        def setter(msg, value):
+            setattr(get_parent(msg), slot_name, value)
+
+    return setter
+
+
+def compile_msg_setters(layout):
+    """
+    Return a list of (setter, converter) entries
+    filling a message from a sequence of values
+    in layout order, converter is None for arrays
+    """
+    setters = []
+    for path, slot_name, slot_type in layout:
+        type_info, array_size = get_type_info(slot_type)
+        convert = type_info.converter if array_size is None else None
+        setters.append((make_setter(path), convert))
+    return setters
+
+
+def compile_msg_getters(layout):
+    """
+    Return a list of (getter, variant type, converter) entries
+    reading the values of a message in layout order,
+    converter is None for values used as they are
+    """
+    getters = []
+    for path, slot_name, slot_type in layout:
+        type_info, array_size = get_type_info(slot_type)
+        if array_size is None:
+            convert = None
+        elif type_info.dtype is not None:
+            convert = make_array_converter(type_info.dtype)
+        else:
+            convert = list
+        getters.append((make_getter(path), type_info.variant_type, convert))
+    return getters
+
+
+def layout_argument_name(path):
+    """
+    Given the path of a layout leaf return its argument name,
+    slot names joined by '/' and array indexes in brackets,
+    e.g. 'pose/position/x' or 'points[1]/y'
+    """
+    name = ''
+    for step in path:
+        if isinstance(step, int):
+            name += '[%d]' % step
+        elif name:
+            name += '/' + step
+        else:
+            name = step
+    return name
 
 
 def slot_msg_to_argument(slot_name, slot_type):
@@ -43,38 +529,11 @@ def slot_msg_to_argument(slot_name, slot_type):
     arg.Name = slot_name
     arg.Description = ua.LocalizedText(slot_name)
 
-    base_type, array_size = extract_array_info(slot_type)
-
-    if base_type in ['bool']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Boolean, 0)
-    elif base_type in ['int8']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.SByte, 0)
-    elif base_type in ['byte', 'uint8']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Byte, 0)
-    elif base_type in ['int16']:
-        rospy.roswarn("'int16' type is deprecated.")
-        arg.DataType = ua.NodeId(ua.ObjectIds.Int16, 0)
-    elif base_type in ['uint16']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.UInt16, 0)
-    elif base_type in ['int', 'int32']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Int32, 0)
-    elif base_type in ['uint32']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.UInt32, 0)
-    elif base_type in ['int64']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Int64, 0)
-    elif base_type in ['uint64']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.UInt64, 0)
-    elif base_type in ['float', 'float32', 'float64']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Float, 0)
-    elif base_type in ['double']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Double, 0)
-    elif base_type in ['string']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.String, 0)
-    elif base_type in ['Time', 'time']:
-        arg.DataType = ua.NodeId(ua.ObjectIds.Time, 0)
-    else:
+    type_info, array_size = get_type_info(slot_type)
+    if type_info is None:
         rospy.logerr("Can't create argument for slot '%s' of type '%s'", slot_name, slot_type)
         return None
+    arg.DataType = type_info.data_type
 
     if array_size is None:
         arg.ValueRank = -1
@@ -86,51 +545,74 @@ def slot_msg_to_argument(slot_name, slot_type):
     return arg
 
 
-def ros_msg_to_variants(msg):
-    vars = []
-    for slot_name, slot_type in zip(msg.__slots__, msg._slot_types):
-        slot_value = getattr(msg, slot_name)
-        if hasattr(slot_value, '_type'):
-            vars_to_merge = ros_msg_to_variants(slot_value)
-            vars.extend(vars_to_merge)
+class NameFilter:
+    """
+    Whitelist and blacklist of ROS names compiled once, exact names
+    are looked up in a set and the glob and regex patterns are merged
+    in one regex, the decision is memoized per name
+    """
+
+    def __init__(self, whitelist, blacklist=()):
+        self.whitelist = compile_name_patterns(whitelist)
+        self.blacklist = compile_name_patterns(blacklist)
+        self.decisions = {}
+
+
+    def __contains__(self, name):
+        try:
+            return self.decisions[name]
+        except KeyError:
+            pass
+
+        decision = match_name(self.whitelist, name) and not match_name(self.blacklist, name)
+        self.decisions[name] = decision
+        return decision
+
+
+def compile_name_patterns(patterns):
+    """
+    Given a list of names and patterns return the set of
+    exact names and the merged regex of the patterns,
+    'ns/' matches the whole namespace, '*' and '?' match within
+    one name level, '**' across levels and 're:' starts a regex
+    """
+    names = set()
+    regexes = []
+    for pattern in patterns:
+        if pattern.startswith('re:'):
+            regexes.append(pattern[3:])
+        elif '*' in pattern or '?' in pattern or pattern.endswith('/'):
+            regexes.append(glob_to_regex(pattern))
         else:
-            var = slot_value_to_variant(slot_value, slot_type)
-            vars.append(var)
-
-    return tuple(vars)
-
-
-def slot_value_to_variant(slot_value, slot_type):
-    rospy.logdebug("converting value: %s of type '%s' to variant.", str(slot_value), slot_type)
-
-    base_type, array_size = extract_array_info(slot_type)
-
-    if base_type in ['bool']:
-        var = ua.Variant(slot_value, ua.VariantType.Boolean)
-    elif base_type in ['int8']:
-        var = ua.Variant(slot_value, ua.VariantType.SByte)
-    elif base_type in ['byte', 'uint8']:
-        var = ua.Variant(slot_value, ua.VariantType.Byte)
-    elif base_type in ['int16']:
-        var = ua.Variant(slot_value, ua.VariantType.Int16)
-    elif base_type in ['uint16']:
-        var = ua.Variant(slot_value, ua.VariantType.UInt16)
-    elif base_type in ['int', 'int32']:
-        var = ua.Variant(slot_value, ua.VariantType.Int32)
-    elif base_type in ['uint32']:
-        var = ua.Variant(slot_value, ua.VariantType.UInt32)
-    elif base_type in ['int64']:
-        var = ua.Variant(slot_value, ua.VariantType.Int64)
-    elif base_type in ['uint64']:
-        var = ua.Variant(slot_value, ua.VariantType.UInt64)
-    elif base_type in ['float', 'float32', 'float64']:
-        var = ua.Variant(slot_value, ua.VariantType.Float)
-    elif base_type in ['double']:
-        var = ua.Variant(slot_value, ua.VariantType.Double)
-    elif base_type in ['string']:
-        var = ua.Variant(slot_value, ua.VariantType.String)
-    else:
-        rospy.logerr("Can't create variant for value: %s of type: %s", str(slot_value), slot_type)
-        return None
+            names.add(pattern)
+
+    if not regexes:
+        return names, None
+    return names, re.compile('(?:%s)\\Z' % '|'.join('(?:%s)' % regex for regex in regexes))
+
+
+def glob_to_regex(pattern):
+    regex = []
+    index = 0
+    while index < len(pattern):
+        if pattern.startswith('**', index):
+            regex.append('.*')
+            index += 2
+            continue
+        char = pattern[index]
+        if char == '*':
+            regex.append('[^/]*')
+        elif char == '?':
+            regex.append('[^/]')
+        else:
+            regex.append(re.escape(char))
+        index += 1
+
+    if pattern.endswith('/'):
+        regex.append('.*')
+    return ''.join(regex)
+
 
-    return var
+def match_name(patterns, name):
+    names, regex = patterns
+    return name in names or (regex is not None and regex.match(name) is not None)